@@ -12,18 +12,131 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 """Module for interacting with the ClusterFuzz deployment."""
+import concurrent.futures
 import logging
 import os
+import shutil
 import sys
-import urllib.error
-import urllib.request
+import tempfile
+import threading
 
 import http_utils
 
 # pylint: disable=wrong-import-position,import-error
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import retry
 import utils
 
+# Corpus transfers are latency bound so doing them concurrently is much faster
+# than doing them one after another. Cap the concurrency so we don't open too
+# many connections to the same host.
+_MAX_CONCURRENT_TRANSFERS = 8
+
+# Corpus zips up to this size are unpacked from memory. This is much smaller
+# than the limit for builds since many corpus zips can be held at once while
+# they are downloaded concurrently and wait to be unpacked.
+_IN_MEMORY_CORPUS_ZIP_MAX_SIZE = 16 * 1024 * 1024
+
+# Getting the latest build name is retried quickly on network errors since it
+# is a single small request.
+_GET_LATEST_BUILD_NAME_RETRIES = 2
+_GET_LATEST_BUILD_NAME_DELAY = 0.25
+
+# Number of builds of each project and sanitizer kept in the build cache.
+_MAX_CACHED_BUILDS = 2
+
+# Prefix of the directories in the build cache that builds are downloaded to
+# before they are complete.
+_TMP_BUILD_DIR_PREFIX = 'tmp-'
+
+# Directories created by _ensure_dir.
+_MADE_DIRS = set()
+
+
+def _ensure_dir(path):
+  """Creates |path| and its parents if they don't exist. Checking a directory
+  that was already created here takes a single stat instead of the few done by
+  os.makedirs. It is still checked in case it was deleted since."""
+  if path in _MADE_DIRS and os.path.isdir(path):
+    return
+  os.makedirs(path, exist_ok=True)
+  _MADE_DIRS.add(path)
+
+
+def _make_leaf_dir(path):
+  """Creates |path| if it doesn't exist. Its parent must already exist."""
+  try:
+    os.mkdir(path)
+  except FileExistsError:
+    pass
+
+
+@retry.wrap(_GET_LATEST_BUILD_NAME_RETRIES,
+            _GET_LATEST_BUILD_NAME_DELAY,
+            exception_type=http_utils.TRANSIENT_ERRORS)
+def _get_with_retries(url):
+  """Sends a GET request for |url|, retrying on transient network errors and
+  status codes, and returns the response."""
+  response = http_utils.get(url)
+  if response.status_code in http_utils.RETRY_STATUS_CODES:
+    response.raise_for_status()
+  return response
+
+
+def _get_corpus_etag_path(corpus_dir):
+  """Returns the path of the file storing the ETag of the corpus that was
+  downloaded to |corpus_dir|. It is kept next to |corpus_dir| rather than in it
+  so it isn't used as a testcase."""
+  return corpus_dir + '.etag'
+
+
+def _read_corpus_etag(corpus_dir):
+  """Returns the ETag of the corpus that was downloaded to |corpus_dir| or None
+  if there is no record of one."""
+  if not os.path.isdir(corpus_dir):
+    return None
+  try:
+    with open(_get_corpus_etag_path(corpus_dir)) as file_handle:
+      return file_handle.read()
+  except FileNotFoundError:
+    return None
+
+
+def _is_corpus_up_to_date(corpus_dir, corpus_url):
+  """Returns True if |corpus_dir| was downloaded from the latest version of the
+  corpus at |corpus_url|. The ETag of the latest version is only requested if
+  there is a local record to compare it to."""
+  local_etag = _read_corpus_etag(corpus_dir)
+  if local_etag is None:
+    return False
+  return http_utils.get_etag(corpus_url) == local_etag
+
+
+def _write_corpus_etag(corpus_dir, etag):
+  """Records that |corpus_dir| was downloaded from the version of the corpus
+  identified by |etag|. Removes any record if |etag| is None."""
+  etag_path = _get_corpus_etag_path(corpus_dir)
+  if etag is None:
+    if os.path.exists(etag_path):
+      os.remove(etag_path)
+    return
+  with open(etag_path, 'w') as file_handle:
+    file_handle.write(etag)
+
+
+def _evict_old_builds(cache_dir):
+  """Deletes all but the |_MAX_CACHED_BUILDS| most recently used builds in
+  |cache_dir|. Builds that are still being downloaded are left alone."""
+  build_dirs = [
+      os.path.join(cache_dir, name)
+      for name in os.listdir(cache_dir)
+      if not name.startswith(_TMP_BUILD_DIR_PREFIX)
+  ]
+  build_dirs.sort(key=os.path.getmtime, reverse=True)
+  for build_dir in build_dirs[_MAX_CACHED_BUILDS:]:
+    logging.info('Deleting old cached build: %s.', build_dir)
+    shutil.rmtree(build_dir, ignore_errors=True)
+
 
 class BaseClusterFuzzDeployment:
   """Base class for ClusterFuzz deployments."""
@@ -33,6 +146,9 @@ class BaseClusterFuzzDeployment:
 
   def __init__(self, config):
     self.config = config
+    # Maps parent dirs to the corpus dirs within them. get_corpus_dir is called
+    # for every fuzz target with the same parent dir.
+    self._corpus_dirs = {}
 
   def download_latest_build(self, parent_dir):
     """Downloads the latest build from ClusterFuzz.
@@ -57,6 +173,22 @@ class BaseClusterFuzzDeployment:
     """
     raise NotImplementedError('Child class must implement method.')
 
+  def download_corpora(self, target_names, parent_dir):
+    """Downloads the corpus for each of |target_names| to |parent_dir|
+    concurrently.
+
+    Returns:
+      A dict mapping each target name to the path of its corpus, or to None if
+      it wasn't downloaded.
+    """
+    target_names = list(target_names)
+    with concurrent.futures.ThreadPoolExecutor(
+        max_workers=_MAX_CONCURRENT_TRANSFERS) as executor:
+      corpus_dirs = executor.map(
+          lambda target_name: self.download_corpus(target_name, parent_dir),
+          target_names)
+      return dict(zip(target_names, corpus_dirs))
+
   def upload_crashes(self, crashes_dir):
     """Uploads crashes in |crashes_dir| to filestore."""
     raise NotImplementedError('Child class must implement method.')
@@ -68,7 +200,19 @@ class BaseClusterFuzzDeployment:
 
   def get_corpus_dir(self, parent_dir):
     """Returns the path to the corpus dir within |parent_dir|."""
-    return os.path.join(parent_dir, self.CORPUS_DIR_NAME)
+    corpus_dir = self._corpus_dirs.get(parent_dir)
+    if corpus_dir is None:
+      corpus_dir = os.path.join(parent_dir, self.CORPUS_DIR_NAME)
+      self._corpus_dirs[parent_dir] = corpus_dir
+    return corpus_dir
+
+  def _prepare_corpus_root(self, parent_dir):
+    """Creates the corpus dir within |parent_dir|, which target corpus dirs are
+    created in, and returns its path. Creating it once up front lets the target
+    corpus dirs be created with a single os.mkdir each."""
+    corpus_root = self.get_corpus_dir(parent_dir)
+    _ensure_dir(corpus_root)
+    return corpus_root
 
   def get_build_dir(self, parent_dir):
     """Returns the path to the build dir for within |parent_dir|."""
@@ -111,23 +255,43 @@ class OSSFuzz(BaseClusterFuzzDeployment):
   # Zip file name containing the corpus.
   CORPUS_ZIP_NAME = 'public.zip'
 
+  def __init__(self, config):
+    super().__init__(config)
+    # Set by get_latest_build_name. The latest build can't change in a way we
+    # care about during a run, so it is only fetched once.
+    self._latest_build_name = None
+    # Maps target names to their corpus URLs. Set by _get_corpus_url.
+    self._corpus_urls = {}
+    # Prefix of project qualified fuzz target names.
+    self._qualified_name_prefix = f'{config.project_name}_'
+    self._corpus_base_url = utils.url_join(
+        utils.GCS_BASE_URL,
+        f'{config.project_name}-backup.clusterfuzz-external.appspot.com',
+        'corpus', 'libFuzzer')
+
   def get_latest_build_name(self):
     """Gets the name of the latest OSS-Fuzz build of a project.
 
     Returns:
       A string with the latest build version or None.
     """
-    version_file = (f'{self.config.project_name}-{self.config.sanitizer}'
-                    '-latest.version')
+    if self._latest_build_name is not None:
+      return self._latest_build_name
+
+    project_name = self.config.project_name
+    version_file = f'{project_name}-{self.config.sanitizer}-latest.version'
     version_url = utils.url_join(utils.GCS_BASE_URL, self.CLUSTERFUZZ_BUILDS,
-                                 self.config.project_name, version_file)
+                                 project_name, version_file)
     try:
-      response = urllib.request.urlopen(version_url)
-    except urllib.error.HTTPError:
+      response = _get_with_retries(version_url)
+    except http_utils.TRANSIENT_ERRORS:
+      response = None
+    if response is None or response.status_code != 200:
       logging.error('Error getting latest build version for %s from: %s.',
-                    self.config.project_name, version_url)
+                    project_name, version_url)
       return None
-    return response.read().decode()
+    self._latest_build_name = response.text
+    return self._latest_build_name
 
   def download_latest_build(self, parent_dir):
     """Downloads the latest OSS-Fuzz build from GCS.
@@ -141,20 +305,68 @@ class OSSFuzz(BaseClusterFuzzDeployment):
       # again.
       return build_dir
 
-    os.makedirs(build_dir, exist_ok=True)
+    _ensure_dir(build_dir)
 
     latest_build_name = self.get_latest_build_name()
     if not latest_build_name:
       return None
 
-    oss_fuzz_build_url = utils.url_join(utils.GCS_BASE_URL,
-                                        self.CLUSTERFUZZ_BUILDS,
-                                        self.config.project_name,
-                                        latest_build_name)
-    if http_utils.download_and_unpack_zip(oss_fuzz_build_url, build_dir):
-      return build_dir
+    # Caching the build only helps when the cache outlives the run, which it
+    # doesn't by default since CIFuzz runs in a fresh container. It also doubles
+    # the disk space used by the build.
+    if not self.config.build_cache_dir or self.config.low_disk_space:
+      # Builds can be hundreds of MB so download them over several connections.
+      if http_utils.download_and_unpack_zip(
+          self._get_build_url(latest_build_name), build_dir, parallel=True):
+        return build_dir
+      return None
 
-    return None
+    cached_build_dir = self._get_cached_build_dir(latest_build_name)
+    if os.path.exists(cached_build_dir):
+      logging.info('Using cached build: %s.', cached_build_dir)
+      # Mark the build as recently used so it isn't evicted.
+      os.utime(cached_build_dir)
+    elif not self._download_build_to_cache(latest_build_name, cached_build_dir):
+      return None
+
+    # Copy rather than hard link the build so that changes to it, like making
+    # fuzz targets executable, don't affect the cached build.
+    shutil.copytree(cached_build_dir, build_dir, dirs_exist_ok=True)
+    return build_dir
+
+  def _get_build_url(self, build_name):
+    """Returns the URL of the OSS-Fuzz build named |build_name|."""
+    return utils.url_join(utils.GCS_BASE_URL, self.CLUSTERFUZZ_BUILDS,
+                          self.config.project_name, build_name)
+
+  def _get_cached_build_dir(self, build_name):
+    """Returns the path that the build named |build_name| is cached at."""
+    return os.path.join(self.config.build_cache_dir, self.config.project_name,
+                        self.config.sanitizer,
+                        os.path.splitext(build_name)[0])
+
+  def _download_build_to_cache(self, build_name, cached_build_dir):
+    """Downloads the build named |build_name| to |cached_build_dir|. Returns
+    True on success."""
+    cache_dir = os.path.dirname(cached_build_dir)
+    _ensure_dir(cache_dir)
+    # Unpack into a temporary directory and then rename it so that a build that
+    # is in the cache is always complete.
+    tmp_build_dir = tempfile.mkdtemp(prefix=_TMP_BUILD_DIR_PREFIX,
+                                     dir=cache_dir)
+    if not http_utils.download_and_unpack_zip(
+        self._get_build_url(build_name), tmp_build_dir, parallel=True):
+      shutil.rmtree(tmp_build_dir, ignore_errors=True)
+      return False
+
+    try:
+      os.rename(tmp_build_dir, cached_build_dir)
+    except OSError:
+      # Another process cached the same build first.
+      shutil.rmtree(tmp_build_dir, ignore_errors=True)
+
+    _evict_old_builds(cache_dir)
+    return True
 
   def upload_latest_build(self, build_dir):  # pylint: disable=no-self-use,unused-argument
     """Noop Impelementation of upload_latest_build."""
@@ -175,25 +387,143 @@ class OSSFuzz(BaseClusterFuzzDeployment):
       The local path to to corpus or None if download failed.
     """
     corpus_dir = self.get_target_corpus_dir(target_name, parent_dir)
+    corpus_url = self._get_corpus_url(target_name)
+    if _is_corpus_up_to_date(corpus_dir, corpus_url):
+      logging.info('Corpus for %s is up to date. Not downloading.', target_name)
+      return corpus_dir
 
-    os.makedirs(corpus_dir, exist_ok=True)
-    # TODO(metzman): Clean up this code.
-    project_qualified_fuzz_target_name = target_name
-    qualified_name_prefix = self.config.project_name + '_'
+    self._prepare_corpus_root(parent_dir)
+    zip_file_handle, etag = http_utils.download_zip(corpus_url)
+    if zip_file_handle is None:
+      return None
 
-    if not target_name.startswith(qualified_name_prefix):
-      project_qualified_fuzz_target_name = qualified_name_prefix + target_name
+    return self._unpack_corpus(target_name, zip_file_handle, etag, parent_dir)
 
-    corpus_url = (f'{utils.GCS_BASE_URL}{self.config.project_name}'
-                  '-backup.clusterfuzz-external.appspot.com/corpus/'
-                  f'libFuzzer/{project_qualified_fuzz_target_name}/'
-                  f'{self.CORPUS_ZIP_NAME}')
+  def download_corpora(self, target_names, parent_dir):
+    """Downloads the latest OSS-Fuzz corpus for each of |target_names|
+    concurrently. Corpora are unpacked on separate threads so that the next
+    download can start while the previous corpus is being unpacked. Downloads
+    wait for a free unpack worker before finishing so that downloaded zips
+    don't pile up waiting to be unpacked.
 
-    if http_utils.download_and_unpack_zip(corpus_url, corpus_dir):
+    Returns:
+      A dict mapping each target name to the local path of its corpus, or to
+      None if the download failed.
+    """
+    self._prepare_corpus_root(parent_dir)
+    with concurrent.futures.ThreadPoolExecutor(
+        max_workers=_MAX_CONCURRENT_TRANSFERS) as download_executor:
+      targets_to_download, corpus_dirs = self._get_targets_to_download(
+          list(target_names), parent_dir, download_executor)
+
+      unpack_slots = threading.BoundedSemaphore(os.cpu_count() or 1)
+      download_futures = {
+          download_executor.submit(self._download_corpus_zip, target_name,
+                                   unpack_slots): target_name
+          for target_name in targets_to_download
+      }
+      with concurrent.futures.ThreadPoolExecutor(
+          max_workers=os.cpu_count() or 1) as unpack_executor:
+        unpack_futures = {}
+        for future in concurrent.futures.as_completed(download_futures):
+          target_name = download_futures[future]
+          zip_file_handle, etag = future.result()
+          if zip_file_handle is None:
+            continue
+          unpack_future = unpack_executor.submit(self._unpack_corpus,
+                                                 target_name, zip_file_handle,
+                                                 etag, parent_dir)
+          unpack_future.add_done_callback(lambda _: unpack_slots.release())
+          unpack_futures[unpack_future] = target_name
+
+        for future in concurrent.futures.as_completed(unpack_futures):
+          corpus_dirs[unpack_futures[future]] = future.result()
+
+    return corpus_dirs
+
+  def _get_targets_to_download(self, target_names, parent_dir, executor):
+    """Checks which of |target_names| don't have an up to date corpus in
+    |parent_dir|. Corpora that have a record of the ETag they were downloaded
+    from are checked concurrently on |executor|.
+
+    Returns:
+      A list of the names of the targets whose corpus needs to be downloaded,
+      and a dict mapping each of |target_names| to its corpus dir if it is up
+      to date or None.
+    """
+    corpus_dirs = [
+        self.get_target_corpus_dir(target_name, parent_dir)
+        for target_name in target_names
+    ]
+    corpus_urls = [
+        self._get_corpus_url(target_name) for target_name in target_names
+    ]
+    targets_to_download = []
+    up_to_date_corpus_dirs = dict.fromkeys(target_names)
+    for target_name, corpus_dir, up_to_date in zip(
+        target_names, corpus_dirs,
+        executor.map(_is_corpus_up_to_date, corpus_dirs, corpus_urls)):
+      if up_to_date:
+        logging.info('Corpus for %s is up to date. Not downloading.',
+                     target_name)
+        up_to_date_corpus_dirs[target_name] = corpus_dir
+      else:
+        targets_to_download.append(target_name)
+
+    return targets_to_download, up_to_date_corpus_dirs
+
+  def _download_corpus_zip(self, target_name, unpack_slots):
+    """Downloads the corpus zip for |target_name| and then waits to acquire one
+    of |unpack_slots|, which is released once the zip has been unpacked.
+
+    Returns:
+      The open zip file and the ETag of the corpus that was downloaded, or
+      (None, None) if the download failed.
+    """
+    zip_file_handle, etag = http_utils.download_zip(
+        self._get_corpus_url(target_name),
+        max_memory_size=_IN_MEMORY_CORPUS_ZIP_MAX_SIZE)
+    if zip_file_handle is not None:
+      unpack_slots.acquire()
+    return zip_file_handle, etag
+
+  def _unpack_corpus(self, target_name, zip_file_handle, etag, parent_dir):
+    """Unpacks the corpus zip for |target_name| in |zip_file_handle|, whose
+    ETag is |etag|, and closes it. The corpus dir within |parent_dir| must
+    already exist.
+
+    Returns:
+      The local path to the corpus or None if unpacking failed.
+    """
+    corpus_dir = self.get_target_corpus_dir(target_name, parent_dir)
+    _make_leaf_dir(corpus_dir)
+    with zip_file_handle:
+      unpacked = http_utils.unpack_zip(zip_file_handle, corpus_dir,
+                                       self._get_corpus_url(target_name))
+    _write_corpus_etag(corpus_dir, etag if unpacked else None)
+    if unpacked:
       return corpus_dir
 
     return None
 
+  def _get_corpus_url(self, target_name):
+    """Returns the URL of the OSS-Fuzz corpus zip for |target_name|."""
+    corpus_url = self._corpus_urls.get(target_name)
+    if corpus_url is not None:
+      return corpus_url
+
+    if target_name.startswith(self._qualified_name_prefix):
+      project_qualified_fuzz_target_name = target_name
+    else:
+      project_qualified_fuzz_target_name = (self._qualified_name_prefix +
+                                            target_name)
+
+    corpus_url = utils.url_join(self._corpus_base_url,
+                                project_qualified_fuzz_target_name,
+                                self.CORPUS_ZIP_NAME)
+    self._corpus_urls[target_name] = corpus_url
+    return corpus_url
+
 
 class NoClusterFuzzDeployment(BaseClusterFuzzDeployment):
   """ClusterFuzzDeployment implementation used when there is no deployment of
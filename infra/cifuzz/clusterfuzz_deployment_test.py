@@ -18,6 +18,7 @@ import unittest
 from unittest import mock
 
 from pyfakefs import fake_filesystem_unittest
+import requests
 
 import clusterfuzz_deployment
 import test_helpers
@@ -54,33 +55,209 @@ class OSSFuzzTest(fake_filesystem_unittest.TestCase):
 
   def setUp(self):
     self.setUpPyfakefs()
+    patcher = mock.patch('http_utils.get_etag', return_value=None)
+    self.addCleanup(patcher.stop)
+    self.mocked_get_etag = patcher.start()
     self.deployment = _create_deployment()
 
-  @mock.patch('http_utils.download_and_unpack_zip', return_value=True)
-  def test_download_corpus(self, mocked_download_and_unpack_zip):
+  def test_download_corpus(self):
     """Tests that we can download a corpus for a valid project."""
-    result = self.deployment.download_corpus(EXAMPLE_FUZZER, self.OUT_DIR)
-    self.assertIsNotNone(result)
+    response = test_helpers.create_zip_response({'testcase': 'contents'})
+    with mock.patch('http_utils.get', return_value=response) as mocked_get:
+      result = self.deployment.download_corpus(EXAMPLE_FUZZER, self.OUT_DIR)
     expected_corpus_dir = os.path.join(self.OUT_DIR, 'cifuzz-corpus',
                                        EXAMPLE_FUZZER)
+    self.assertEqual(result, expected_corpus_dir)
+    self.assertTrue(
+        os.path.exists(os.path.join(expected_corpus_dir, 'testcase')))
     expected_url = ('https://storage.googleapis.com/example-backup.'
                     'clusterfuzz-external.appspot.com/corpus/libFuzzer/'
                     'example_crash_fuzzer/public.zip')
-    call_args, _ = mocked_download_and_unpack_zip.call_args
-    self.assertEqual(call_args, (expected_url, expected_corpus_dir))
+    call_args, _ = mocked_get.call_args
+    self.assertEqual(call_args, (expected_url,))
+    # There is no local corpus to compare the latest corpus' ETag to.
+    self.mocked_get_etag.assert_not_called()
 
-  @mock.patch('http_utils.download_and_unpack_zip', return_value=False)
+  @mock.patch('http_utils.download_zip', return_value=(None, None))
+  def test_download_corpus_unqualified_name(self, mocked_download_zip):
+    """Tests that the project name is prepended to fuzz target names in corpus
+    URLs when they don't already start with it."""
+    self.deployment.download_corpus('fuzzer', self.OUT_DIR)
+    expected_url = ('https://storage.googleapis.com/example-backup.'
+                    'clusterfuzz-external.appspot.com/corpus/libFuzzer/'
+                    'example_fuzzer/public.zip')
+    call_args, _ = mocked_download_zip.call_args
+    self.assertEqual(call_args[0], expected_url)
+
+  def test_download_corpus_up_to_date(self):
+    """Tests that a corpus isn't downloaded again if it is up to date."""
+    self.mocked_get_etag.return_value = 'etag'
+    expected_corpus_dir = os.path.join(self.OUT_DIR, 'cifuzz-corpus',
+                                       EXAMPLE_FUZZER)
+    response = test_helpers.create_zip_response({'testcase': 'contents'},
+                                                headers={'ETag': 'etag'})
+    with mock.patch('http_utils.get', return_value=response) as mocked_get:
+      for _ in range(2):
+        self.assertEqual(
+            self.deployment.download_corpus(EXAMPLE_FUZZER, self.OUT_DIR),
+            expected_corpus_dir)
+    self.assertEqual(mocked_get.call_count, 1)
+    self.assertEqual(self.mocked_get_etag.call_count, 1)
+
+  def test_download_corpus_changed(self):
+    """Tests that a corpus is downloaded again if the latest corpus has a
+    different ETag than the one that was downloaded."""
+    self.mocked_get_etag.return_value = 'new-etag'
+    response = test_helpers.create_zip_response({'testcase': 'contents'},
+                                                headers={'ETag': 'old-etag'})
+    with mock.patch('http_utils.get', return_value=response) as mocked_get:
+      for _ in range(2):
+        self.deployment.download_corpus(EXAMPLE_FUZZER, self.OUT_DIR)
+    self.assertEqual(mocked_get.call_count, 2)
+
+  @mock.patch('http_utils.get', return_value=mock.MagicMock(status_code=404))
   def test_download_fail(self, _):
     """Tests that when downloading fails, None is returned."""
     corpus_path = self.deployment.download_corpus(EXAMPLE_FUZZER, self.OUT_DIR)
     self.assertIsNone(corpus_path)
 
+  def test_download_corpora(self):
+    """Tests that download_corpora unpacks the corpus of each target that was
+    downloaded."""
+    other_fuzzer = 'other_fuzzer'
+
+    def get(url, **kwargs):  # pylint: disable=unused-argument
+      if other_fuzzer in url:
+        return mock.MagicMock(status_code=404)
+      return test_helpers.create_zip_response({'testcase': 'contents'})
+
+    with mock.patch('http_utils.get', side_effect=get):
+      result = self.deployment.download_corpora([EXAMPLE_FUZZER, other_fuzzer],
+                                                self.OUT_DIR)
+    expected_corpus_dir = os.path.join(self.OUT_DIR, 'cifuzz-corpus',
+                                       EXAMPLE_FUZZER)
+    self.assertEqual(result, {
+        EXAMPLE_FUZZER: expected_corpus_dir,
+        other_fuzzer: None
+    })
+    self.assertTrue(
+        os.path.exists(os.path.join(expected_corpus_dir, 'testcase')))
+    self.mocked_get_etag.assert_not_called()
+
+  @mock.patch('os.cpu_count', return_value=None)
+  def test_download_corpora_more_targets_than_unpack_workers(self, _):
+    """Tests that download_corpora unpacks every corpus when there are more
+    corpora than unpack workers."""
+    target_names = [f'fuzzer{i}' for i in range(4)]
+    response = test_helpers.create_zip_response({'testcase': 'contents'})
+    with mock.patch('http_utils.get', return_value=response):
+      result = self.deployment.download_corpora(target_names, self.OUT_DIR)
+    self.assertEqual(
+        result, {
+            target_name: os.path.join(self.OUT_DIR, 'cifuzz-corpus',
+                                      target_name)
+            for target_name in target_names
+        })
+
+  def _download_and_unpack_zip(self, url, extract_directory, parallel):  # pylint: disable=unused-argument
+    """Fake download_and_unpack_zip that creates a fuzz target in
+    |extract_directory|."""
+    self.fs.create_file(os.path.join(extract_directory, EXAMPLE_FUZZER))
+    return True
+
+  @mock.patch('clusterfuzz_deployment.OSSFuzz.get_latest_build_name',
+              return_value='example-address-1.zip')
+  def test_download_latest_build_cached(self, _):
+    """Tests that a build is only downloaded once when it is cached."""
+    self.deployment.config.build_cache_dir = '/cache'
+    with mock.patch(
+        'http_utils.download_and_unpack_zip',
+        side_effect=self._download_and_unpack_zip) as mocked_download:
+      for parent_dir in ['/workspace1', '/workspace2']:
+        build_dir = self.deployment.download_latest_build(parent_dir)
+        self.assertTrue(os.path.exists(os.path.join(build_dir, EXAMPLE_FUZZER)))
+    self.assertEqual(mocked_download.call_count, 1)
+    self.assertEqual(os.listdir('/cache/example/address'),
+                     ['example-address-1'])
+
+  @mock.patch('clusterfuzz_deployment.OSSFuzz.get_latest_build_name',
+              return_value='example-address-1.zip')
+  def test_download_latest_build_no_cache(self, _):
+    """Tests that builds aren't cached when there is no build cache dir or
+    there is little disk space."""
+    for build_cache_dir, low_disk_space in [(None, False), ('/cache', True)]:
+      self.deployment.config.build_cache_dir = build_cache_dir
+      self.deployment.config.low_disk_space = low_disk_space
+      parent_dir = f'/workspace-{low_disk_space}'
+      with mock.patch('http_utils.download_and_unpack_zip',
+                      side_effect=self._download_and_unpack_zip):
+        build_dir = self.deployment.download_latest_build(parent_dir)
+      self.assertTrue(os.path.exists(os.path.join(build_dir, EXAMPLE_FUZZER)))
+    self.assertFalse(os.path.exists('/cache'))
+
+  def test_evict_old_builds(self):
+    """Tests that only the most recently used builds are kept in the cache and
+    that builds being downloaded aren't evicted."""
+    cache_dir = '/cache'
+    build_names = ['build-1', 'build-2', 'build-3', 'tmp-build-4']
+    for mtime, build_name in enumerate(build_names):
+      build_dir = os.path.join(cache_dir, build_name)
+      self.fs.create_dir(build_dir)
+      os.utime(build_dir, (mtime, mtime))
+    clusterfuzz_deployment._evict_old_builds(cache_dir)  # pylint: disable=protected-access
+    self.assertCountEqual(os.listdir(cache_dir),
+                          ['build-2', 'build-3', 'tmp-build-4'])
+
   def test_get_latest_build_name(self):
     """Tests that the latest build name can be retrieved from GCS."""
     latest_build_name = self.deployment.get_latest_build_name()
     self.assertTrue(latest_build_name.endswith('.zip'))
     self.assertTrue('address' in latest_build_name)
 
+  @mock.patch('http_utils.get', return_value=mock.MagicMock(status_code=404))
+  def test_get_latest_build_name_http_error(self, _):
+    """Tests that None is returned when the latest build version can't be
+    retrieved."""
+    self.assertIsNone(self.deployment.get_latest_build_name())
+
+  @mock.patch('time.sleep')
+  def test_get_latest_build_name_retries(self, _):
+    """Tests that getting the latest build name is retried on network
+    errors."""
+    response = mock.MagicMock(status_code=200, text='build.zip')
+    with mock.patch('http_utils.get',
+                    side_effect=[ConnectionResetError, response]) as mocked_get:
+      self.assertEqual(self.deployment.get_latest_build_name(), 'build.zip')
+    self.assertEqual(mocked_get.call_count, 2)
+
+  @mock.patch('time.sleep')
+  def test_get_latest_build_name_retries_transient_status(self, _):
+    """Tests that getting the latest build name is retried when the server is
+    unavailable."""
+    unavailable_response = requests.Response()
+    unavailable_response.status_code = 503
+    response = mock.MagicMock(status_code=200, text='build.zip')
+    with mock.patch('http_utils.get',
+                    side_effect=[unavailable_response, response]) as mocked_get:
+      self.assertEqual(self.deployment.get_latest_build_name(), 'build.zip')
+    self.assertEqual(mocked_get.call_count, 2)
+
+  @mock.patch('time.sleep')
+  @mock.patch('http_utils.get', side_effect=ConnectionResetError)
+  def test_get_latest_build_name_network_error(self, mocked_get, _):
+    """Tests that None is returned when getting the latest build name keeps
+    failing with network errors."""
+    self.assertIsNone(self.deployment.get_latest_build_name())
+    self.assertEqual(mocked_get.call_count, 3)
+
+  def test_get_latest_build_name_cached(self):
+    """Tests that the latest build name is only fetched once."""
+    response = mock.MagicMock(status_code=200, text='build.zip')
+    with mock.patch('http_utils.get', return_value=response) as mocked_get:
+      self.assertEqual(self.deployment.get_latest_build_name(), 'build.zip')
+      self.assertEqual(self.deployment.get_latest_build_name(), 'build.zip')
+    self.assertEqual(mocked_get.call_count, 1)
+
 
 if __name__ == '__main__':
   unittest.main()
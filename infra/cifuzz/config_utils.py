@@ -107,6 +107,9 @@ class BaseConfig:
     logging.debug('Is github: %s.', self.is_github)
     # TODO(metzman): Parse env like we do in ClusterFuzz.
     self.low_disk_space = environment.get('LOW_DISK_SPACE', False)
+    # Directory to cache downloaded ClusterFuzz builds in. Only useful on
+    # runners that keep it between runs.
+    self.build_cache_dir = os.getenv('BUILD_CACHE_DIR')
 
     self.github_token = os.environ.get('GITHUB_TOKEN')
 
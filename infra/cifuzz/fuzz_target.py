@@ -103,9 +103,11 @@ class FuzzTarget:
 
     # TODO(metzman): Stop using /out for artifacts and corpus. Use another
     # directory.
-    # If corpus can be downloaded use it for fuzzing.
-    self.latest_corpus_path = self.clusterfuzz_deployment.download_corpus(
-        self.target_name, self.out_dir)
+    # If corpus can be downloaded use it for fuzzing. It may have already been
+    # downloaded along with the corpora of the other fuzz targets.
+    if not self.latest_corpus_path:
+      self.latest_corpus_path = self.clusterfuzz_deployment.download_corpus(
+          self.target_name, self.out_dir)
     if self.latest_corpus_path:
       command += docker.get_args_mapping_host_path_to_container(
           self.latest_corpus_path)
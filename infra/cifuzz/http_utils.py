@@ -12,6 +12,7 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 """Utility module for HTTP."""
+import concurrent.futures
 import logging
 import os
 import sys
@@ -19,6 +20,8 @@ import tempfile
 import zipfile
 
 import requests
+import requests.adapters
+import requests.structures
 
 # pylint: disable=wrong-import-position,import-error
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -27,14 +30,104 @@ import retry
 _DOWNLOAD_URL_RETRIES = 3
 _DOWNLOAD_URL_BACKOFF = 1
 
+# Downloads are only retried on errors that are likely to go away on their own.
+# Other errors, like a 404, fail the download immediately.
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+TRANSIENT_ERRORS = (requests.exceptions.ConnectionError,
+                    requests.exceptions.Timeout,
+                    requests.exceptions.ChunkedEncodingError,
+                    requests.exceptions.HTTPError, ConnectionError,
+                    TimeoutError)
 
-def download_and_unpack_zip(url, extract_directory, headers=None):
+# Size of the chunks that downloads are streamed to disk in.
+_DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+
+# Parallel downloads split files at least this big into this many byte ranges
+# and download each range over its own connection. A single connection usually
+# can't saturate the network on CI runners.
+_PARALLEL_DOWNLOAD_MIN_SIZE = 64 * 1024 * 1024
+_PARALLEL_DOWNLOAD_RANGES = 4
+
+# Zip files up to this size are downloaded to memory instead of to disk before
+# being unpacked. Bigger ones are written to a temporary file.
+_IN_MEMORY_ZIP_MAX_SIZE = 256 * 1024 * 1024
+
+# Seconds to wait for a connection and for each read from it. Without these, a
+# request to an unresponsive server blocks the thread making it forever. Reads
+# are timed individually so big downloads aren't affected.
+_TIMEOUT = (10, 60)
+
+# Maximum number of connections kept open to each host. This needs to be at
+# least the number of downloads done in parallel (e.g. corpora or byte ranges of
+# a build) or connections are thrown away instead of being reused.
+_MAX_CONNECTIONS_PER_HOST = 16
+
+
+def _create_session():
+  """Returns a session whose connections are kept alive and pooled. Retries are
+  left to the callers so they aren't compounded."""
+  session = requests.Session()
+  adapter = requests.adapters.HTTPAdapter(
+      pool_connections=4, pool_maxsize=_MAX_CONNECTIONS_PER_HOST)
+  session.mount('https://', adapter)
+  session.mount('http://', adapter)
+  return session
+
+
+# Shared by every request made in this process so that connections to the same
+# host (e.g. storage.googleapis.com) are kept alive and reused instead of doing
+# a new TCP and TLS handshake for each download.
+_SESSION = _create_session()
+
+
+def get(url, headers=None, stream=False):
+  """Sends a GET request for |url| over the shared session and returns the
+  response. If |stream| is True, the body is not read until it is accessed."""
+  return _SESSION.get(url, headers=headers, stream=stream, timeout=_TIMEOUT)
+
+
+def head(url, headers=None):
+  """Sends a HEAD request for |url| over the shared session and returns the
+  response."""
+  return _SESSION.head(url,
+                       headers=headers,
+                       allow_redirects=True,
+                       timeout=_TIMEOUT)
+
+
+def get_etag(url, headers=None):
+  """Returns a string identifying the current contents of the file located at
+  |url|, or None if it can't be retrieved. This is GCS's x-goog-hash header
+  when present and the standard ETag header otherwise."""
+  try:
+    response = head(url, headers=headers)
+  except requests.exceptions.RequestException:
+    logging.info('Unable to get ETag of: %s.', url, exc_info=True)
+    return None
+
+  if response.status_code != 200:
+    return None
+  return _get_etag_from_headers(response.headers)
+
+
+def _get_etag_from_headers(headers):
+  """Returns the string identifying the contents of a file from the |headers|
+  of a response for it, or None if there isn't one."""
+  return headers.get('x-goog-hash', headers.get('ETag'))
+
+
+def download_and_unpack_zip(url,
+                            extract_directory,
+                            headers=None,
+                            parallel=False):
   """Downloads and unpacks a zip file from an HTTP URL.
 
   Args:
     url: A url to the zip file to be downloaded and unpacked.
     extract_directory: The path where the zip file should be extracted to.
     headers: (Optional) HTTP headers to send with the download request.
+    parallel: (Optional) If True, download large zip files in byte ranges
+      over multiple connections when the server supports it.
 
   Returns:
     True on success.
@@ -46,39 +139,103 @@ def download_and_unpack_zip(url, extract_directory, headers=None):
     logging.error('Extract directory: %s does not exist.', extract_directory)
     return False
 
-  # Gives the temporary zip file a unique identifier in the case that
-  # that download_and_unpack_zip is done in parallel.
-  with tempfile.NamedTemporaryFile(suffix='.zip') as tmp_file:
-    if not download_url(url, tmp_file.name, headers=headers):
-      return False
+  zip_file_handle, _ = download_zip(url, headers=headers, parallel=parallel)
+  if zip_file_handle is None:
+    return False
+
+  with zip_file_handle:
+    return unpack_zip(zip_file_handle, extract_directory, url)
+
+
+class _SpooledTemporaryFile(tempfile.SpooledTemporaryFile):
+  """SpooledTemporaryFile that can be read by zipfile. Before Python 3.11,
+  SpooledTemporaryFile doesn't implement seekable, which zipfile needs."""
+
+  def seekable(self):
+    """Returns True if the underlying file supports random access."""
+    return self._file.seekable()
+
 
-    try:
-      with zipfile.ZipFile(tmp_file.name, 'r') as zip_file:
-        zip_file.extractall(extract_directory)
-    except zipfile.BadZipFile:
-      logging.error('Error unpacking zip from %s. Bad Zipfile.', url)
-      return False
+def download_zip(url,
+                 headers=None,
+                 parallel=False,
+                 max_memory_size=_IN_MEMORY_ZIP_MAX_SIZE):
+  """Downloads a zip file from an HTTP URL to an anonymous temporary file.
+
+  Args:
+    url: A url to the zip file to be downloaded.
+    headers: (Optional) HTTP headers to send with the download request.
+    parallel: (Optional) If True, download large zip files in byte ranges
+      over multiple connections when the server supports it.
+    max_memory_size: (Optional) The size in bytes up to which the zip file is
+      kept in memory instead of being written to disk.
+
+  Returns:
+    The temporary file, positioned at its start, and the ETag of the file that
+    was downloaded, as returned by get_etag, on success. The caller must close
+    the file. (None, None) on failure.
+  """
+  # Use an anonymous temporary file so that downloads can be done in parallel.
+  # Small zips never touch the disk and are unpacked straight from memory.
+  tmp_file = _SpooledTemporaryFile(max_size=max_memory_size, suffix='.zip')
+  response_headers = requests.structures.CaseInsensitiveDict()
+  downloaded = (parallel and download_ranges_to_file(
+      url, tmp_file, headers=headers, response_headers=response_headers))
+  if not downloaded and not download_to_file(
+      url, tmp_file, headers=headers, response_headers=response_headers):
+    tmp_file.close()
+    return None, None
+
+  return tmp_file, _get_etag_from_headers(response_headers)
+
+
+def unpack_zip(zip_file_handle, extract_directory, url):
+  """Unpacks the zip file downloaded from |url| in |zip_file_handle| to
+  |extract_directory|. Returns True on success."""
+  try:
+    with zipfile.ZipFile(zip_file_handle, 'r') as zip_file:
+      zip_file.extractall(extract_directory)
+  except zipfile.BadZipFile:
+    logging.error('Error unpacking zip from %s. Bad Zipfile.', url)
+    return False
 
   return True
 
 
-def download_url(*args, **kwargs):
-  """Wrapper around _download_url that returns False if _download_url
+def download_url(url, filename, headers=None):
+  """Downloads the file located at |url|, using HTTP to |filename|. Returns
+  True on success."""
+  with open(filename, 'wb') as file_handle:
+    if download_to_file(url, file_handle, headers=headers):
+      return True
+
+  os.remove(filename)
+  return False
+
+
+def download_to_file(*args, **kwargs):
+  """Wrapper around _download_to_file that returns False if _download_to_file
   exceptions."""
   try:
-    return _download_url(*args, **kwargs)
+    return _download_to_file(*args, **kwargs)
   except Exception:  # pylint: disable=broad-except
     return False
 
 
-@retry.wrap(_DOWNLOAD_URL_RETRIES, _DOWNLOAD_URL_BACKOFF)
-def _download_url(url, filename, headers=None):
-  """Downloads the file located at |url|, using HTTP to |filename|.
+@retry.wrap(_DOWNLOAD_URL_RETRIES,
+            _DOWNLOAD_URL_BACKOFF,
+            exception_type=TRANSIENT_ERRORS)
+def _download_to_file(url, file_handle, headers=None, response_headers=None):
+  """Downloads the file located at |url|, using HTTP to |file_handle|. The
+  response is streamed to |file_handle| in chunks so that it is never held in
+  memory in full.
 
   Args:
     url: A url to a file to download.
-    filename: The path the file should be downloaded to.
+    file_handle: A writable binary file object to download the file to.
     headers: (Optional) HTTP headers to send with the download request.
+    response_headers: (Optional) A dict that the headers of the response are
+      added to on success.
 
   Returns:
     True on success.
@@ -86,14 +243,115 @@ def _download_url(url, filename, headers=None):
   if headers is None:
     headers = {}
 
-  response = requests.get(url, headers=headers)
+  response = get(url, headers=headers, stream=True)
+  if response.status_code in RETRY_STATUS_CODES:
+    # Release the connection of the streamed response before retrying.
+    response.close()
+    response.raise_for_status()
 
   if response.status_code != 200:
     logging.error('Unable to download from: %s. Code: %d. Content: %s.', url,
                   response.status_code, response.content)
     return False
 
-  with open(filename, 'wb') as file_handle:
-    file_handle.write(response.content)
+  # Discard anything written by a previous attempt.
+  file_handle.seek(0)
+  file_handle.truncate()
+  for chunk in response.iter_content(chunk_size=_DOWNLOAD_CHUNK_SIZE):
+    file_handle.write(chunk)
+  file_handle.seek(0)
 
+  if response_headers is not None:
+    response_headers.update(response.headers)
   return True
+
+
+def download_ranges_to_file(*args, **kwargs):
+  """Wrapper around _download_ranges_to_file that returns False if
+  _download_ranges_to_file exceptions."""
+  try:
+    return _download_ranges_to_file(*args, **kwargs)
+  except Exception:  # pylint: disable=broad-except
+    logging.info('Parallel download failed.', exc_info=True)
+    return False
+
+
+def _download_ranges_to_file(url,
+                             file_handle,
+                             headers=None,
+                             response_headers=None):
+  """Downloads the file located at |url| to |file_handle| by downloading byte
+  ranges of it in parallel.
+
+  Args:
+    url: A url to a file to download.
+    file_handle: A writable binary file object with a file descriptor to
+      download the file to.
+    headers: (Optional) HTTP headers to send with the download requests.
+    response_headers: (Optional) A dict that the headers of the response to
+      the HEAD request that the ranges are based on are added to on success.
+
+  Returns:
+    True on success. False if the file is too small to be worth downloading in
+    parallel, its size is unknown or the download failed.
+  """
+  if headers is None:
+    headers = {}
+
+  response = head(url, headers=headers)
+  size = int(response.headers.get('Content-Length', 0))
+  if response.status_code != 200 or size < _PARALLEL_DOWNLOAD_MIN_SIZE:
+    return False
+
+  range_size = -(-size // _PARALLEL_DOWNLOAD_RANGES)
+  byte_ranges = [(start, min(start + range_size, size) - 1)
+                 for start in range(0, size, range_size)]
+
+  # Get the descriptor first, this makes a SpooledTemporaryFile move to disk.
+  file_descriptor = file_handle.fileno()
+  file_handle.seek(0)
+  file_handle.truncate(size)
+  with concurrent.futures.ThreadPoolExecutor(
+      max_workers=len(byte_ranges)) as executor:
+    results = list(
+        executor.map(
+            lambda byte_range: _download_range(url, file_descriptor, byte_range,
+                                               headers), byte_ranges))
+  file_handle.seek(0)
+  if not all(results):
+    return False
+
+  if response_headers is not None:
+    response_headers.update(response.headers)
+  return True
+
+
+@retry.wrap(_DOWNLOAD_URL_RETRIES,
+            _DOWNLOAD_URL_BACKOFF,
+            exception_type=TRANSIENT_ERRORS)
+def _download_range(url, file_descriptor, byte_range, headers):
+  """Downloads |byte_range|, a (start, end) tuple of inclusive offsets, of the
+  file located at |url| and writes it at the same offset in |file_descriptor|.
+  Returns True on success."""
+  start, end = byte_range
+  range_headers = dict(headers)
+  range_headers['Range'] = f'bytes={start}-{end}'
+  response = get(url, headers=range_headers, stream=True)
+  if response.status_code in RETRY_STATUS_CODES:
+    # Release the connection of the streamed response before retrying.
+    response.close()
+    response.raise_for_status()
+
+  # A 200 means the server ignored the range and is sending the whole file.
+  if response.status_code != 206:
+    logging.info('Range request to: %s not supported. Code: %d.', url,
+                 response.status_code)
+    response.close()
+    return False
+
+  offset = start
+  for chunk in response.iter_content(chunk_size=_DOWNLOAD_CHUNK_SIZE):
+    os.pwrite(file_descriptor, chunk, offset)
+    offset += len(chunk)
+
+  return offset == end + 1
@@ -13,12 +13,16 @@
 # limitations under the License.
 """Tests for http_utils.py"""
 
+import os
+import tempfile
 import unittest
 from unittest import mock
 
 from pyfakefs import fake_filesystem_unittest
+import requests
 
 import http_utils
+import test_helpers
 
 mocked_get_response = mock.MagicMock(status_code=200, content=b'')
 
@@ -29,7 +33,7 @@ class DownloadUrlTest(unittest.TestCase):
   FILE_PATH = '/tmp/file'
 
   @mock.patch('time.sleep')
-  @mock.patch('requests.get', return_value=mocked_get_response)
+  @mock.patch('requests.Session.get', return_value=mocked_get_response)
   def test_download_url_no_error(self, mocked_urlretrieve, _):
     """Tests that download_url works when there is no error."""
     self.assertTrue(http_utils.download_url(self.URL, self.FILE_PATH))
@@ -37,7 +41,7 @@ class DownloadUrlTest(unittest.TestCase):
 
   @mock.patch('time.sleep')
   @mock.patch('logging.error')
-  @mock.patch('requests.get',
+  @mock.patch('requests.Session.get',
               return_value=mock.MagicMock(status_code=404, content=b''))
   def test_download_url_http_error(self, mocked_get, mocked_error, _):
     """Tests that download_url doesn't retry when there is an HTTP error."""
@@ -48,13 +52,83 @@ class DownloadUrlTest(unittest.TestCase):
     self.assertEqual(1, mocked_get.call_count)
 
   @mock.patch('time.sleep')
-  @mock.patch('requests.get', side_effect=ConnectionResetError)
+  @mock.patch('requests.Session.get', side_effect=ConnectionResetError)
   def test_download_url_connection_error(self, mocked_get, mocked_sleep):
     """Tests that download_url doesn't retry when there is an HTTP error."""
     self.assertFalse(http_utils.download_url(self.URL, self.FILE_PATH))
     self.assertEqual(4, mocked_get.call_count)
     self.assertEqual(3, mocked_sleep.call_count)
 
+  @mock.patch('time.sleep')
+  def test_download_url_transient_http_error(self, mocked_sleep):
+    """Tests that download_url retries when the server is unavailable."""
+    unavailable_response = requests.Response()
+    unavailable_response.status_code = 503
+    unavailable_response.close = mock.MagicMock()
+    with mock.patch('requests.Session.get',
+                    side_effect=[unavailable_response,
+                                 mocked_get_response]) as mocked_get:
+      self.assertTrue(http_utils.download_url(self.URL, self.FILE_PATH))
+    self.assertEqual(2, mocked_get.call_count)
+    self.assertEqual(1, mocked_sleep.call_count)
+    unavailable_response.close.assert_called_once()
+
+  @mock.patch('time.sleep')
+  @mock.patch('requests.Session.get', side_effect=ValueError)
+  def test_download_url_non_transient_error(self, mocked_get, mocked_sleep):
+    """Tests that download_url doesn't retry on errors that aren't
+    transient."""
+    self.assertFalse(http_utils.download_url(self.URL, self.FILE_PATH))
+    self.assertEqual(1, mocked_get.call_count)
+    self.assertEqual(0, mocked_sleep.call_count)
+
+
+def _create_range_response(url, headers=None, **kwargs):  # pylint: disable=unused-argument
+  """Returns a mocked response to a range request for |DownloadRangesTest.DATA|.
+  """
+  start, end = headers['Range'][len('bytes='):].split('-')
+  chunk = DownloadRangesTest.DATA[int(start):int(end) + 1]
+  return mock.MagicMock(status_code=206,
+                        iter_content=mock.MagicMock(return_value=[chunk]))
+
+
+@mock.patch('http_utils._PARALLEL_DOWNLOAD_MIN_SIZE', 10)
+class DownloadRangesTest(unittest.TestCase):
+  """Tests download_ranges_to_file."""
+  URL = 'https://example.com/file'
+  DATA = bytes(range(100))
+
+  def setUp(self):
+    head_response = mock.MagicMock(
+        status_code=200, headers={'Content-Length': str(len(self.DATA))})
+    patcher = mock.patch('requests.Session.head', return_value=head_response)
+    self.addCleanup(patcher.stop)
+    patcher.start()
+
+  @mock.patch('requests.Session.get', side_effect=_create_range_response)
+  def test_download_ranges(self, mocked_get):
+    """Tests that a file is downloaded correctly in ranges."""
+    with tempfile.TemporaryFile() as tmp_file:
+      self.assertTrue(http_utils.download_ranges_to_file(self.URL, tmp_file))
+      self.assertEqual(tmp_file.read(), self.DATA)
+    self.assertEqual(4, mocked_get.call_count)
+
+  @mock.patch('requests.Session.get',
+              return_value=mock.MagicMock(status_code=200))
+  def test_ranges_not_supported(self, _):
+    """Tests that download_ranges_to_file returns False when the server doesn't
+    support range requests."""
+    with tempfile.TemporaryFile() as tmp_file:
+      self.assertFalse(http_utils.download_ranges_to_file(self.URL, tmp_file))
+
+  @mock.patch('requests.Session.get')
+  def test_small_file(self, mocked_get):
+    """Tests that small files aren't downloaded in ranges."""
+    with mock.patch('http_utils._PARALLEL_DOWNLOAD_MIN_SIZE', 1000):
+      with tempfile.TemporaryFile() as tmp_file:
+        self.assertFalse(http_utils.download_ranges_to_file(self.URL, tmp_file))
+    self.assertEqual(0, mocked_get.call_count)
+
 
 class DownloadAndUnpackZipTest(fake_filesystem_unittest.TestCase):
   """Tests download_and_unpack_zip."""
@@ -62,10 +136,45 @@ class DownloadAndUnpackZipTest(fake_filesystem_unittest.TestCase):
   def setUp(self):
     self.setUpPyfakefs()
 
-  @mock.patch('requests.get', return_value=mocked_get_response)
+  @mock.patch('requests.Session.get', return_value=mocked_get_response)
   def test_bad_zip_download(self, _):
     """Tests download_and_unpack_zip returns none when a bad zip is passed."""
     self.fs.create_file('/url_tmp.zip', contents='Test file.')
     self.assertFalse(
         http_utils.download_and_unpack_zip('/not/a/real/url',
                                            '/extract-directory'))
+
+  def test_download_and_unpack_zip(self):
+    """Tests that download_and_unpack_zip unpacks a zip that is streamed in
+    chunks."""
+    extract_directory = '/extract-directory'
+    self.fs.create_dir(extract_directory)
+    response = test_helpers.create_zip_response({'fuzzer': 'contents'})
+    with mock.patch('requests.Session.get', return_value=response):
+      self.assertTrue(
+          http_utils.download_and_unpack_zip('https://example.com/file.zip',
+                                             extract_directory))
+    with open(os.path.join(extract_directory, 'fuzzer')) as file_handle:
+      self.assertEqual(file_handle.read(), 'contents')
+
+
+class DownloadZipTest(unittest.TestCase):
+  """Tests download_zip."""
+
+  def test_etag_from_download(self):
+    """Tests that download_zip returns the ETag from the response that the zip
+    was downloaded from."""
+    response = test_helpers.create_zip_response(
+        {'fuzzer': 'contents'}, headers={'X-Goog-Hash': 'crc32c=hash'})
+    with mock.patch('requests.Session.get', return_value=response):
+      zip_file_handle, etag = http_utils.download_zip(
+          'https://example.com/file.zip')
+    zip_file_handle.close()
+    self.assertEqual(etag, 'crc32c=hash')
+
+  @mock.patch('requests.Session.get',
+              return_value=mock.MagicMock(status_code=404))
+  def test_download_fail(self, _):
+    """Tests that download_zip returns (None, None) when downloading fails."""
+    self.assertEqual(http_utils.download_zip('https://example.com/file.zip'),
+                     (None, None))
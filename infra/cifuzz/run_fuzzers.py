@@ -120,6 +120,21 @@ class BaseFuzzTargetRunner:
     fuzz_seconds = self.config.fuzz_seconds
 
     min_seconds_per_fuzzer = fuzz_seconds // fuzzers_left_to_run
+
+    # Download the corpora of all fuzz targets concurrently instead of one at a
+    # time before each target is run. This counts against the time for fuzzing
+    # just like downloading each corpus did. Don't do this when disk space is
+    # low since then only one corpus should be on disk at a time, each fuzz
+    # target downloads its own corpus before it is run instead.
+    corpus_paths = {}
+    if not self.config.low_disk_space:
+      start_time = time.time()
+      corpus_paths = self.clusterfuzz_deployment.download_corpora([
+          os.path.basename(target_path)
+          for target_path in self.fuzz_target_paths
+      ], self.out_dir)
+      fuzz_seconds -= time.time() - start_time
+
     bug_found = False
     for target_path in self.fuzz_target_paths:
       # By doing this, we can ensure that every fuzz target runs for at least
@@ -129,6 +144,7 @@ class BaseFuzzTargetRunner:
                         min_seconds_per_fuzzer)
 
       target = self.create_fuzz_target_obj(target_path, run_seconds)
+      target.latest_corpus_path = corpus_paths.get(target.target_name)
       start_time = time.time()
       result = self.run_fuzz_target(target)
 
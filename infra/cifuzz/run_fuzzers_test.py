@@ -221,12 +221,14 @@ class CiFuzzTargetRunnerTest(fake_filesystem_unittest.TestCase):
   def setUp(self):
     self.setUpPyfakefs()
 
+  @mock.patch('clusterfuzz_deployment.OSSFuzz.download_corpora',
+              return_value={'target1': 'corpus'})
   @mock.patch('utils.get_fuzz_targets')
   @mock.patch('run_fuzzers.CiFuzzTargetRunner.run_fuzz_target')
   @mock.patch('run_fuzzers.CiFuzzTargetRunner.create_fuzz_target_obj')
   def test_run_fuzz_targets_quits(self, mocked_create_fuzz_target_obj,
                                   mocked_run_fuzz_target,
-                                  mocked_get_fuzz_targets):
+                                  mocked_get_fuzz_targets, _):
     """Tests that run_fuzz_targets quits on the first crash it finds."""
     workspace = 'workspace'
     out_path = os.path.join(workspace, 'out')
@@ -251,6 +253,35 @@ class CiFuzzTargetRunnerTest(fake_filesystem_unittest.TestCase):
     self.assertTrue(runner.run_fuzz_targets())
     self.assertIn('target1-address-testcase', os.listdir(runner.crashes_dir))
     self.assertEqual(mocked_run_fuzz_target.call_count, 1)
+    # The corpus downloaded before fuzzing is used by the target.
+    self.assertEqual(magic_mock.latest_corpus_path, 'corpus')
+
+  @mock.patch('clusterfuzz_deployment.OSSFuzz.download_corpora')
+  @mock.patch('utils.get_fuzz_targets', return_value=['target1', 'target2'])
+  @mock.patch('run_fuzzers.CiFuzzTargetRunner.run_fuzz_target',
+              return_value=fuzz_target.FuzzResult(None, None, None))
+  @mock.patch('run_fuzzers.CiFuzzTargetRunner.create_fuzz_target_obj')
+  def test_run_fuzz_targets_low_disk_space(self, mocked_create_fuzz_target_obj,
+                                           mocked_run_fuzz_target, _,
+                                           mocked_download_corpora):
+    """Tests that run_fuzz_targets leaves downloading each corpus to its fuzz
+    target when disk space is low."""
+    workspace = 'workspace'
+    self.fs.create_dir(os.path.join(workspace, 'out'))
+    config = test_helpers.create_run_config(fuzz_seconds=FUZZ_SECONDS,
+                                            workspace=workspace,
+                                            project_name=EXAMPLE_PROJECT,
+                                            low_disk_space=True)
+    runner = run_fuzzers.CiFuzzTargetRunner(config)
+    runner.initialize()
+    magic_mock = mock.MagicMock()
+    magic_mock.target_name = 'target1'
+    magic_mock.latest_corpus_path = None
+    mocked_create_fuzz_target_obj.return_value = magic_mock
+    self.assertFalse(runner.run_fuzz_targets())
+    self.assertEqual(mocked_run_fuzz_target.call_count, 2)
+    mocked_download_corpora.assert_not_called()
+    self.assertIsNone(magic_mock.latest_corpus_path)
 
 
 class BatchFuzzTargetRunnerTest(fake_filesystem_unittest.TestCase):
@@ -259,12 +290,14 @@ class BatchFuzzTargetRunnerTest(fake_filesystem_unittest.TestCase):
   def setUp(self):
     self.setUpPyfakefs()
 
+  @mock.patch('clusterfuzz_deployment.OSSFuzz.download_corpora',
+              return_value={})
   @mock.patch('utils.get_fuzz_targets')
   @mock.patch('run_fuzzers.BatchFuzzTargetRunner.run_fuzz_target')
   @mock.patch('run_fuzzers.BatchFuzzTargetRunner.create_fuzz_target_obj')
   def test_run_fuzz_targets_quits(self, mocked_create_fuzz_target_obj,
                                   mocked_run_fuzz_target,
-                                  mocked_get_fuzz_targets):
+                                  mocked_get_fuzz_targets, _):
     """Tests that run_fuzz_targets doesn't quit on the first crash it finds."""
     workspace = 'workspace'
     out_path = os.path.join(workspace, 'out')
@@ -14,9 +14,11 @@
 """Contains convenient helpers for writing tests."""
 
 import contextlib
+import io
 import os
 import shutil
 import tempfile
+import zipfile
 from unittest import mock
 
 import config_utils
@@ -48,6 +50,21 @@ def create_run_config(**kwargs):
   return _create_config(config_utils.RunFuzzersConfig, **kwargs)
 
 
+def create_zip_response(files, headers=None):
+  """Returns a mocked HTTP response whose body is a zip containing |files|, a
+  dict mapping file names to their contents, and that has |headers|."""
+  zip_buffer = io.BytesIO()
+  with zipfile.ZipFile(zip_buffer, 'w') as zip_file:
+    for name, contents in files.items():
+      zip_file.writestr(name, contents)
+  zip_bytes = zip_buffer.getvalue()
+  chunks = [zip_bytes[:10], zip_bytes[10:]]
+  return mock.MagicMock(status_code=200,
+                        content=zip_bytes,
+                        headers=headers or {},
+                        iter_content=mock.MagicMock(return_value=chunks))
+
+
 def patch_environ(testcase_obj, env=None):
   """Patch environment."""
   if env is None: